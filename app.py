@@ -2,19 +2,22 @@
 
 import streamlit as st
 import geopandas as gpd
-from shapely.geometry import LineString, MultiLineString
-from shapely.affinity import rotate
+import shapely
 import numpy as np
+import io
+import json
 import tempfile
 import zipfile
 import os
 import leafmap.foliumap as leafmap
 import streamlit.components.v1 as components
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from fpdf import FPDF
 import folium
 import pandas as pd
 from concurrent.futures import ProcessPoolExecutor
+from numba import njit, prange, set_num_threads, config as numba_config
 
 st.set_page_config(page_title="Field Path Optimizer", layout="wide")
 st.title("Field Path Optimizer by Rain Plaado")
@@ -25,149 +28,298 @@ angle_step = 0.5
 
 uploaded_file = st.file_uploader("Upload zipped shapefile (.zip)", type="zip")
 
+def field_edges(field_geom, origin):
+    # Polygon edges (exterior and holes) as coordinate arrays relative to the origin
+    rings = shapely.get_rings(shapely.get_parts(field_geom))
+    coords, ring_idx = shapely.get_coordinates(rings, return_index=True)
+    x, y = coords[:, 0] - origin.x, coords[:, 1] - origin.y
+    # Consecutive vertices of the same ring form an edge; this skips the jump between rings
+    same_ring = ring_idx[:-1] == ring_idx[1:]
+    return x[:-1][same_ring], y[:-1][same_ring], x[1:][same_ring], y[1:][same_ring]
+
+def field_outlines(field_geom, origin):
+    # Convex hull of each polygon part, concatenated, with offsets marking where each part starts.
+    # The hull has the same rotated y-extent as the part at every angle, with far fewer vertices.
+    hulls = shapely.convex_hull(shapely.get_parts(field_geom))
+    coords, part_idx = shapely.get_coordinates(hulls, return_index=True)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(part_idx, minlength=len(hulls)))])
+    return coords[:, 0] - origin.x, coords[:, 1] - origin.y, offsets
+
+@njit(cache=True)
+def pass_count(x0, y0, x1, y1, c, s, miny, machine_width):
+    # Each pass is a pair of edge crossings on a scanline, so no clipping is needed to count them.
+    # Scanlines sit at miny + k * machine_width; an edge is crossed by those in (lo, hi]
+    crossings = 0
+    for e in range(len(x0)):
+        ry0 = s * x0[e] + c * y0[e]
+        ry1 = s * x1[e] + c * y1[e]
+        lo, hi = min(ry0, ry1), max(ry0, ry1)
+        crossings += int(np.floor((hi - miny) / machine_width) - np.floor((lo - miny) / machine_width))
+    return crossings // 2
+
+@njit(cache=True)
+def pass_lower_bound(px, py, part_offsets, c, s, machine_width):
+    # Every scanline strictly inside a part's y-extent cuts that part at least once.
+    # Hull vertices are field vertices, so the lowest one is also the field's scanline origin.
+    n_parts = len(part_offsets) - 1
+    lows = np.empty(n_parts)
+    highs = np.empty(n_parts)
+    for p in range(n_parts):
+        lows[p], highs[p] = np.inf, -np.inf
+        for v in range(part_offsets[p], part_offsets[p + 1]):
+            ry = s * px[v] + c * py[v]
+            lows[p] = min(lows[p], ry)
+            highs[p] = max(highs[p], ry)
+    miny = lows.min()
+    bound = 0
+    for p in range(n_parts):
+        inside = np.ceil((highs[p] - miny) / machine_width) - np.floor((lows[p] - miny) / machine_width) - 1
+        bound += max(int(inside), 0)
+    return bound, miny
+
+@njit(parallel=True, cache=True)
+def sweep_pass_counts(x0, y0, x1, y1, px, py, part_offsets, c, s, machine_width):
+    # Angles are independent and run in parallel. The angle with the smallest lower bound is counted
+    # first; any angle whose bound is above that count cannot win and keeps its bound instead of a
+    # full count, which leaves the argmin over the result unchanged.
+    counts = np.empty(len(c), dtype=np.int64)
+    minys = np.empty(len(c))
+    for a in prange(len(c)):
+        counts[a], minys[a] = pass_lower_bound(px, py, part_offsets, c[a], s[a], machine_width)
+    bounds = counts.copy()
+    first = np.argmin(bounds)
+    best = pass_count(x0, y0, x1, y1, c[first], s[first], minys[first], machine_width)
+    counts[first] = best
+    for a in prange(len(c)):
+        if a != first and bounds[a] <= best:
+            counts[a] = pass_count(x0, y0, x1, y1, c[a], s[a], minys[a], machine_width)
+    return counts
+
+def tramlines(field_geom, angle, origin, machine_width):
+    # Rotate the edge arrays with the sweep's arithmetic instead of building a rotated polygon;
+    # the scanlines share pass_count's grid origin and (lo, hi] crossing rule
+    c, s = np.cos(np.deg2rad(angle)), np.sin(np.deg2rad(angle))
+    x0, y0, x1, y1 = field_edges(field_geom, origin)
+    x0, y0, x1, y1 = c * x0 - s * y0, s * x0 + c * y0, c * x1 - s * y1, s * x1 + c * y1
+    miny, maxy = y0.min(), y0.max()
+    # Scanlines from pass_count's grid origin up to maxy; one landing exactly on maxy is kept,
+    # since the (lo, hi] rule counts it as crossed (e.g. along a flat top edge)
+    ys = miny + machine_width * np.arange(1, int((maxy - miny) // machine_width) + 1)
+
+    coords = np.empty((len(ys), 2, 2))
+    coords[:, 0, 0] = min(x0.min(), x1.min()) - 1
+    coords[:, 1, 0] = max(x0.max(), x1.max()) + 1
+    coords[:, :, 1] = ys[:, None]
+    lines = shapely.linestrings(coords)
+
+    # Bulk-loaded index over the field's edges; each scanline only meets edges whose box it crosses
+    edges = shapely.linestrings(np.stack([np.column_stack([x0, y0]), np.column_stack([x1, y1])], axis=1))
+    line_idx, edge_idx = shapely.STRtree(edges).query(lines)
+    y = ys[line_idx]
+    ey0, ey1 = y0[edge_idx], y1[edge_idx]
+    # Same (lo, hi] crossing rule as pass_count, so the crossings on each scanline pair up into passes;
+    # a vertex that only touches a scanline is crossed by both its edges and pairs up at zero length
+    crossed = (np.minimum(ey0, ey1) < y) & (y <= np.maximum(ey0, ey1))
+    line_idx, edge_idx, y = line_idx[crossed], edge_idx[crossed], y[crossed]
+    x = x0[edge_idx] + (y - y0[edge_idx]) * (x1[edge_idx] - x0[edge_idx]) / (y1[edge_idx] - y0[edge_idx])
+
+    order = np.lexsort((x, line_idx))
+    x, y = x[order].reshape(-1, 2), y[order].reshape(-1, 2)
+    keep = x[:, 1] > x[:, 0]
+    x, y = x[keep], y[keep]
+    if angle != 0:
+        # Rotate the pass endpoints back to field orientation before any geometry is built
+        x, y = c * x + s * y, c * y - s * x
+    return shapely.linestrings(np.stack([x + origin.x, y + origin.y], axis=-1))
+
+def field_labels(polygon_gdf, shp):
+    # Label each field with its first non-empty name column, looked up across all rows at once
+    possible_name_fields = ['Name', 'Field', 'FIELD_NAME', 'ID', 'Label']
+    names = polygon_gdf.reindex(columns=possible_name_fields).astype(object).to_numpy()
+    found = pd.notnull(names)
+    first = found.argmax(axis=1)
+    labels = []
+    for i, col in enumerate(first):
+        label = str(names[i, col]) if found[i, col] else ""
+        labels.append(label or f"{os.path.basename(shp)} - Field {i + 1}")
+    return labels
+
+def init_worker(width, step, threads):
+    # Settings shared by every field are sent once per worker process rather than with each field,
+    # and the candidate angles' cos/sin tables are built once here instead of per field
+    global worker_machine_width, worker_angles, worker_cos, worker_sin
+    worker_machine_width = width
+    worker_angles = np.arange(0, 180, step)
+    worker_cos, worker_sin = np.cos(np.deg2rad(worker_angles)), np.sin(np.deg2rad(worker_angles))
+    set_num_threads(threads)
+
 def optimize_field_for_parallel(args):
-    row, i, origin, field_geom, shp, crs, machine_width, angle_step = args
-    best_angle = None
-    best_pass_count = float("inf")
-    best_lines = []
-
-    for angle in np.arange(0, 180, angle_step):
-        rotated_field = rotate(field_geom, angle, origin=origin, use_radians=False)
-        miny, maxy = rotated_field.bounds[1], rotated_field.bounds[3]
-        y = miny - 2 * machine_width
-        lines = []
-        while y <= maxy + 2 * machine_width:
-            lines.append(LineString([(origin.x - 1e5, y), (origin.x + 1e5, y)]))
-            y += machine_width
-
-        clipped_rotated = [line.intersection(rotated_field) for line in lines if not line.intersection(rotated_field).is_empty]
-        rotated_back = [rotate(line, -angle, origin=origin, use_radians=False) for line in clipped_rotated]
-        final_lines = [line.intersection(field_geom) for line in rotated_back if not line.intersection(field_geom).is_empty]
-
-        count = 0
-        for geom in final_lines:
-            if geom.is_empty:
-                continue
-            elif isinstance(geom, LineString):
-                count += 1
-            elif isinstance(geom, MultiLineString):
-                count += len(geom.geoms)
-            else:
-                continue
-
-        if count < best_pass_count:
-            best_pass_count = count
-            best_angle = angle
-            best_lines = final_lines
+    # Fields arrive as flat coordinate arrays, which pickle far cheaper than shapely objects and rows
+    field_name, file, field_no, geom_type, coords, offsets, ox, oy, crs = args
+    machine_width, angles = worker_machine_width, worker_angles
+    field_geom = shapely.from_ragged_array(geom_type, coords, offsets)[0]
+    origin = shapely.Point(ox, oy)
+
+    counts = sweep_pass_counts(*field_edges(field_geom, origin), *field_outlines(field_geom, origin), worker_cos, worker_sin, machine_width)
+    best_angle = angles[int(np.argmin(counts))]
+
+    # Report the lines actually drawn: the sweep also counts a vertex that only touches a scanline,
+    # which tramlines drops as a zero-length pass
+    best_lines = tramlines(field_geom, best_angle, origin, machine_width)
 
     forward = (best_angle - 90) % 360
     reverse = (forward + 180) % 360
 
-    possible_name_fields = ['Name', 'Field', 'FIELD_NAME', 'ID', 'Label']
-    field_name = None
-    for col in possible_name_fields:
-        if col in row and pd.notnull(row[col]):
-            field_name = str(row[col])
-            break
-    if not field_name:
-        field_name = f"{os.path.basename(shp)} - Field {i + 1}"
-
     return {
-        "file": os.path.basename(shp),
-        "field": i + 1,
+        "file": file,
+        "field": field_no,
         "name": field_name,
         "heading_fwd": forward,
         "heading_rev": reverse,
-        "passes": best_pass_count,
+        "passes": len(best_lines),
         "geom": field_geom,
         "lines": best_lines,
         "crs": crs,
         "origin": origin
     }
 
-if uploaded_file:
-    with tempfile.TemporaryDirectory() as tmpdir:
-        with zipfile.ZipFile(uploaded_file, 'r') as zip_ref:
-            zip_ref.extractall(tmpdir)
-
-        shp_files = []
-        for root, _, files in os.walk(tmpdir):
-            for file in files:
-                if file.endswith(".shp"):
-                    shp_files.append(os.path.join(root, file))
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_fields(zip_bytes):
+    # Parsing and reprojecting the shapefiles is only redone when a different zip is uploaded
+    with zipfile.ZipFile(io.BytesIO(zip_bytes), 'r') as zip_ref:
+        names = zip_ref.namelist()
+        shp_files = [name for name in names if name.endswith(".shp")]
 
         if not shp_files:
-            st.error("No .shp files found in the zip.")
-            st.stop()
+            return None
 
-        all_args = []
+        fields = []
         for shp in shp_files:
-            gdf_all = gpd.read_file(shp)
+            # Repack this shapefile's sidecar files into a small in-memory zip that GDAL reads directly,
+            # so nothing is extracted to disk and shapefiles in subfolders still open
+            stem = os.path.splitext(shp)[0]
+            single = io.BytesIO()
+            with zipfile.ZipFile(single, 'w') as single_zip:
+                for name in names:
+                    if os.path.splitext(name)[0] == stem:
+                        single_zip.writestr(os.path.basename(name), zip_ref.read(name))
+            single.seek(0)
+
+            gdf_all = gpd.read_file(single, engine="pyogrio")
             if gdf_all.crs is None or not gdf_all.crs.is_projected:
                 gdf_all = gdf_all.to_crs(epsg=32750)
 
             polygon_gdf = gdf_all[gdf_all.geometry.type.isin(["Polygon", "MultiPolygon"])].reset_index(drop=True)
 
-            for i, row in polygon_gdf.iterrows():
-                field_geom = row.geometry.buffer(0)
-                origin = field_geom.centroid
-                all_args.append((row, i, origin, field_geom, shp, gdf_all.crs, machine_width, angle_step))
-
-        with st.spinner("Calculating optimal tramlines for all fields... This may take a few minutes."):
-            with ProcessPoolExecutor() as executor:
-                results = executor.map(optimize_field_for_parallel, all_args)
-
-            summary = list(results)  # safely outside of executor context
-
-        best_overall = min(summary, key=lambda x: x['passes'])
-
-        st.subheader("\U0001F4CA Field Summary")
-        for item in summary:
-            st.markdown(f"**{item['name']}**: {item['passes']} passes @ {item['heading_fwd']:.1f}° forward")
-
-        st.subheader("\U0001F30D Optimized Fields Map")
-        center = summary[0]['geom'].centroid
-        m = leafmap.Map(center=(center.y, center.x), zoom=17)
-        m.add_basemap("HYBRID")
-
-        for item in summary:
-            field_gdf = gpd.GeoDataFrame(geometry=[item['geom']], crs=item['crs']).to_crs(epsg=4326)
-            lines_gdf = gpd.GeoDataFrame(geometry=item['lines'], crs=item['crs']).to_crs(epsg=4326)
-            m.add_gdf(field_gdf, style={"color": "green", "fillOpacity": 0.2})
-            m.add_gdf(lines_gdf, style={"color": "blue", "weight": 2})
-            label_point = field_gdf.geometry.iloc[0].centroid
-            folium.Marker(
-                location=[label_point.y, label_point.x],
-                icon=folium.DivIcon(html=f"""
-                    <div style="
-                        font-size: 16px;
-                        font-weight: bold;
-                        color: black;
-                        background-color: transparent;
-                        padding: 0px;
-                        border: none;
-                        text-align: center;
-                    ">
-                        Best heading: {item['heading_fwd']:.1f}°
-                    </div>
-                """)
-            ).add_to(m)
-
-        components.html(m.to_html(), height=600)
-
-        st.subheader("\U0001F4C4 Download PDF Report")
-        pdf = FPDF()
-        pdf.set_auto_page_break(auto=True, margin=15)
-
-        for item in summary:
-            fig, ax = plt.subplots(figsize=(8, 8), dpi=300)  # Larger size + high DPI
+            crs_wkt = gdf_all.crs.to_wkt()
+            geoms = shapely.buffer(polygon_gdf.geometry.to_numpy(), 0)
+            origins = shapely.get_coordinates(shapely.centroid(geoms))
+            for i, (field_geom, name) in enumerate(zip(geoms, field_labels(polygon_gdf, shp))):
+                geom_type, coords, offsets = shapely.to_ragged_array([field_geom])
+                fields.append((name, os.path.basename(shp), i + 1, geom_type, coords, offsets, origins[i, 0], origins[i, 1], crs_wkt))
+    return fields
+
+def optimize_fields(fields, machine_width, angle_step):
+    # Fields run in separate processes; spare cores go to each field's parallel angle sweep
+    cpus = os.cpu_count() or 1
+    workers = max(1, min(len(fields), cpus))
+    chunksize = max(1, len(fields) // (4 * workers))
+    # set_num_threads cannot exceed the NUMBA_NUM_THREADS the workers were started with
+    threads = min(max(1, cpus // workers), numba_config.NUMBA_NUM_THREADS)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(machine_width, angle_step, threads)) as executor:
+        results = executor.map(optimize_field_for_parallel, fields, chunksize=chunksize)
+
+    return list(results)  # safely outside of executor context
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def optimize_upload(zip_bytes, machine_width, angle_step):
+    # Keyed on the raw upload and settings, so reruns with the same inputs (e.g. the PDF download
+    # click) skip the whole pipeline without hashing the parsed fields first
+    fields = load_fields(zip_bytes)
+    if fields is None:
+        return None
+    return optimize_fields(fields, machine_width, angle_step)
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def render_map_html(fields_geojson, lines_geojson, labels, center):
+    # The map HTML inlines every layer; it is only rebuilt when a layer or label changes
+    m = leafmap.Map(center=center, zoom=17)
+    m.add_basemap("HYBRID")
+    fields_gdf = gpd.GeoDataFrame.from_features(json.loads(fields_geojson), crs="EPSG:4326")
+    lines_gdf = gpd.GeoDataFrame.from_features(json.loads(lines_geojson), crs="EPSG:4326")
+    m.add_gdf(fields_gdf, style={"color": "green", "fillOpacity": 0.2})
+    m.add_gdf(lines_gdf, style={"color": "blue", "weight": 2})
+
+    for lat, lon, heading in labels:
+        folium.Marker(
+            location=[lat, lon],
+            icon=folium.DivIcon(html=f"""
+                <div style="
+                    font-size: 16px;
+                    font-weight: bold;
+                    color: black;
+                    background-color: transparent;
+                    padding: 0px;
+                    border: none;
+                    text-align: center;
+                ">
+                    Best heading: {heading:.1f}°
+                </div>
+            """)
+        ).add_to(m)
+
+    return m.to_html()
+
+if uploaded_file:
+    with st.spinner("Calculating optimal tramlines for all fields... This may take a few minutes."):
+        summary = optimize_upload(uploaded_file.getvalue(), machine_width, angle_step)
+
+    if summary is None:
+        st.error("No .shp files found in the zip.")
+        st.stop()
+
+    best_overall = min(summary, key=lambda x: x['passes'])
+
+    st.subheader("\U0001F4CA Field Summary")
+    for item in summary:
+        st.markdown(f"**{item['name']}**: {item['passes']} passes @ {item['heading_fwd']:.1f}° forward")
+
+    st.subheader("\U0001F30D Optimized Fields Map")
+    center = summary[0]['geom'].centroid
+
+    # Reproject each source CRS once and draw all fields and all tramlines as one layer each
+    field_layers, line_layers, headings = [], [], []
+    for crs in dict.fromkeys(item['crs'] for item in summary):
+        items = [item for item in summary if item['crs'] == crs]
+        field_layers.append(gpd.GeoDataFrame(geometry=[item['geom'] for item in items], crs=crs).to_crs(epsg=4326))
+        line_layers.append(gpd.GeoDataFrame(geometry=np.concatenate([item['lines'] for item in items]), crs=crs).to_crs(epsg=4326))
+        headings.extend(item['heading_fwd'] for item in items)
+    fields_gdf = pd.concat(field_layers, ignore_index=True)
+    lines_gdf = pd.concat(line_layers, ignore_index=True)
+    label_points = shapely.centroid(fields_gdf.geometry.to_numpy())
+    labels = tuple((point.y, point.x, heading) for point, heading in zip(label_points, headings))
+
+    map_html = render_map_html(fields_gdf.to_json(), lines_gdf.to_json(), labels, (center.y, center.x))
+    components.html(map_html, height=600)
+
+    st.subheader("\U0001F4C4 Download PDF Report")
+    pdf = FPDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+
+    # One Agg figure at the resolution the 160 mm image box actually shows, cleared and reused per field
+    fig = Figure(figsize=(6, 6), dpi=150)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+
+    # FPDF only reads images from disk and caches them by path, so each field gets its own file
+    with tempfile.TemporaryDirectory() as img_dir:
+        for n, item in enumerate(summary):
+            ax.cla()
             gpd.GeoSeries(item['geom']).boundary.plot(ax=ax, color='black')
             gpd.GeoSeries(item['lines']).plot(ax=ax, color='blue', linewidth=0.5)
-            plt.axis('off')
-            img_path = tempfile.NamedTemporaryFile(suffix=".png", delete=False).name
-            plt.savefig(img_path, bbox_inches='tight', dpi=300)  # High resolution
-
-            plt.close(fig)
+            ax.set_axis_off()
+            img_path = os.path.join(img_dir, f"field_{n}.png")
+            fig.savefig(img_path, bbox_inches='tight', dpi=150)
 
             pdf.add_page()
             pdf.set_font("Arial", size=12)
@@ -176,7 +328,7 @@ if uploaded_file:
             pdf.cell(200, 8, txt=f"Passes needed: {item['passes']}", ln=True)
             pdf.image(img_path, x=15, y=40, w=160)
 
-        tmp_pdf = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-        pdf.output(tmp_pdf.name)
-        with open(tmp_pdf.name, "rb") as f:
-            st.download_button("Download PDF Summary", f.read(), file_name="field_optimization_report.pdf")
\ No newline at end of file
+    tmp_pdf = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
+    pdf.output(tmp_pdf.name)
+    with open(tmp_pdf.name, "rb") as f:
+        st.download_button("Download PDF Summary", f.read(), file_name="field_optimization_report.pdf")
\ No newline at end of file